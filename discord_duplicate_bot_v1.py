@@ -13,231 +13,393 @@ import discord
 from discord.ext import commands
 import os
 import sys
-import json
+try:
+    import orjson
+except ImportError:
+    # Fall back to a stdlib shim exposing the same bytes-in/bytes-out
+    # surface so the rest of the file never branches on which is loaded
+    import json as _json
+
+    class orjson: # type: ignore
+        """Minimal stand-in for the orjson API used in this file."""
+        OPT_INDENT_2 = 1
+        JSONDecodeError = _json.JSONDecodeError
+
+        @staticmethod
+        def loads(data):
+            return _json.loads(data)
+
+        @staticmethod
+        def dumps(obj, option=0):
+            indent = 2 if option & orjson.OPT_INDENT_2 else None
+            return _json.dumps(obj, indent=indent).encode('utf-8')
 import asyncio
 import io
+import sqlite3
+import concurrent.futures
+import numpy as np
 from PIL import Image, UnidentifiedImageError
-import imagehash
-from functools import partial
+from functools import partial, wraps
+import inspect
+from dataclasses import dataclass, fields, replace
 from dotenv import load_dotenv
-import traceback
+import queue
+import re
+import threading
+import time
 import typing
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
 
 # --- Constants ---
 CONFIG_FILE_PATH = 'server_configs.json' # Stores configs for all guilds
 DEFAULT_COMMAND_PREFIX = "!"
 HASH_FILENAME_PREFIX = "hashes_" # Prefix for per-guild hash files
-VALID_SCOPES = ["server", "channel"]
-VALID_CHECK_MODES = ["strict", "owner_allowed"]
+VALID_SCOPES = frozenset({"server", "channel"})
+VALID_CHECK_MODES = frozenset({"strict", "owner_allowed"})
+MAX_IMAGE_BYTES = 25 * 1024 * 1024 # Skip attachments larger than this without downloading
+# Static image formats dHash handles well; animated formats (GIF etc.)
+# hash only their first frame and produce misleading matches, so skip them
+HASHABLE_CONTENT_TYPES = frozenset({"image/jpeg", "image/png", "image/webp"})
+# Accepted spellings for boolean config values
+_TRUE_TOKENS = frozenset({'true', 'on', 'yes', '1', 'enable', 'enabled'})
+_FALSE_TOKENS = frozenset({'false', 'off', 'no', '0', 'disable', 'disabled'})
 
 # --- Load Environment Variables ---
-load_dotenv()
+# Parsed once at import; override=False keeps a token already present in
+# the real environment authoritative over the .env file
+load_dotenv(override=False)
 BOT_TOKEN = os.environ.get("DISCORD_BOT_TOKEN")
 
 # --- Global Configuration Cache & Locks ---
 server_configs = {} # Holds {guild_id: config_dict, ...}
 config_lock = asyncio.Lock() # Lock for accessing/saving the main config file
-hash_file_locks = {} # {guild_id: asyncio.Lock()}
+# Fixed striped-lock table for hash-DB access: guilds map onto one of 64
+# locks by guild_id, giving O(1) memory instead of one lock per guild and
+# avoiding unsynchronized mutation of a shared dict.
+_HASH_LOCK_STRIPES = 64
+_HASH_LOCKS = [asyncio.Lock() for _ in range(_HASH_LOCK_STRIPES)]
 
 # --- Configuration Loading/Saving ---
 
-def get_default_guild_config(guild_id):
-    """Returns a dictionary with default settings for a guild."""
-    return {
-        "hash_db_file": f"{HASH_FILENAME_PREFIX}{guild_id}.json",
-        "hash_size": 8,
-        "similarity_threshold": 5,
-        "allowed_channel_ids": None,
-        "react_to_duplicates": True,
-        "delete_duplicates": False,
-        "duplicate_reaction_emoji": "⚠️",
-        "duplicate_scope": "server", # Default scope
-        "duplicate_check_mode": "strict" # Default check mode
+@dataclass(slots=True)
+class GuildConfig:
+    """
+    Validated per-guild settings. A slotted dataclass instead of a plain
+    dict: type coercion happens once in from_dict, and the per-message hot
+    path reads attributes instead of repeating dict lookups per field.
+    """
+    hash_db_file: str
+    hash_size: int = 8
+    similarity_threshold: int = 5
+    # Kept as a set in memory for O(1) add/remove/contains; serialized as a
+    # sorted list by to_dict() so the JSON on disk stays stable and diffable
+    allowed_channel_ids: typing.Optional[set] = None
+    react_to_duplicates: bool = True
+    delete_duplicates: bool = False
+    duplicate_reaction_emoji: str = "⚠️"
+    duplicate_scope: str = "server" # Default scope
+    duplicate_check_mode: str = "strict" # Default check mode
+
+    # Field -> coercion callable, applied when the field is present in the
+    # loaded data; declarative counterpart of the per-field if statements
+    _COERCE = {
+        'hash_size': int,
+        'similarity_threshold': int,
+        'react_to_duplicates': bool,
+        'delete_duplicates': bool,
     }
 
-def validate_config_data(config_data):
-     """Validates config, including new check_mode."""
-     # Start with defaults and update with loaded data to ensure all keys exist
-     validated = get_default_guild_config(0).copy() # Use 0 as placeholder ID for defaults
-     validated.update(config_data)
-     try:
-        # Coerce types
-        validated['hash_size'] = int(validated['hash_size'])
-        validated['similarity_threshold'] = int(validated['similarity_threshold'])
-        validated['react_to_duplicates'] = bool(validated['react_to_duplicates'])
-        validated['delete_duplicates'] = bool(validated['delete_duplicates'])
-
-        # Validate scope
-        if validated.get('duplicate_scope') not in VALID_SCOPES:
-             print(f"Warning: Invalid 'duplicate_scope' value '{validated.get('duplicate_scope')}' found. Resetting to 'server'.", file=sys.stderr)
-             validated['duplicate_scope'] = "server"
-
-        # Validate check mode
-        if validated.get('duplicate_check_mode') not in VALID_CHECK_MODES:
-             print(f"Warning: Invalid 'duplicate_check_mode' value '{validated.get('duplicate_check_mode')}' found. Resetting to 'strict'.", file=sys.stderr)
-             validated['duplicate_check_mode'] = "strict"
-
-        # Validate allowed_channel_ids (must be list of ints or None)
-        if validated['allowed_channel_ids'] is not None:
-            if isinstance(validated['allowed_channel_ids'], list):
-                 # Filter out non-integer elements and convert valid ones
-                 validated['allowed_channel_ids'] = [int(ch_id) for ch_id in validated['allowed_channel_ids'] if str(ch_id).isdigit()]
-                 # If list becomes empty after filtering, set to None
-                 if not validated['allowed_channel_ids']:
-                      validated['allowed_channel_ids'] = None
+    @classmethod
+    def from_dict(cls, guild_id, config_data):
+        """Builds a validated config from loaded JSON data, coercing types
+        and keeping defaults for missing or invalid fields."""
+        validated = get_default_guild_config(guild_id)
+        data = config_data if isinstance(config_data, dict) else {}
+        try:
+            # Coerce types via the shared table
+            for key, coerce in cls._COERCE.items():
+                if key in data: setattr(validated, key, coerce(data[key]))
+            if isinstance(data.get('duplicate_reaction_emoji'), str):
+                validated.duplicate_reaction_emoji = data['duplicate_reaction_emoji']
+
+            # Validate scope
+            scope = data.get('duplicate_scope', validated.duplicate_scope)
+            if scope in VALID_SCOPES:
+                validated.duplicate_scope = scope
+            else:
+                logger.warning("Invalid 'duplicate_scope' value '%s' found. Resetting to 'server'.", scope)
+
+            # Validate check mode
+            mode = data.get('duplicate_check_mode', validated.duplicate_check_mode)
+            if mode in VALID_CHECK_MODES:
+                validated.duplicate_check_mode = mode
             else:
-                 # If it's not None and not a list, reset to None
-                 print(f"Warning: 'allowed_channel_ids' was not a list. Resetting to None.", file=sys.stderr)
-                 validated['allowed_channel_ids'] = None
+                logger.warning("Invalid 'duplicate_check_mode' value '%s' found. Resetting to 'strict'.", mode)
+
+            # Validate allowed_channel_ids (must be a list/set of ints or None)
+            channels = data.get('allowed_channel_ids')
+            if channels is not None:
+                if isinstance(channels, (list, set)):
+                    # Filter out non-integer elements and convert valid ones;
+                    # an empty result means "all channels", i.e. None
+                    channels = {int(ch_id) for ch_id in channels if str(ch_id).isdigit()}
+                    validated.allowed_channel_ids = channels or None
+                else:
+                    logger.warning("'allowed_channel_ids' was not a list. Resetting to None.")
+
+        except (ValueError, TypeError) as e:
+            # Catch potential errors during type coercion
+            logger.warning("Error validating config types: %s. Some defaults may be used.", e)
+        return validated
+
+    def to_dict(self):
+        """Plain-dict view used for JSON serialization and display."""
+        data = {f.name: getattr(self, f.name) for f in fields(self)}
+        # The in-memory channel set is serialized as a sorted list
+        if data['allowed_channel_ids'] is not None:
+            data['allowed_channel_ids'] = sorted(data['allowed_channel_ids'])
+        return data
 
-     except (ValueError, TypeError, KeyError) as e:
-          # Catch potential errors during type coercion or key access
-          print(f"Warning: Error validating config types or keys: {e}. Some defaults may be used.", file=sys.stderr)
-          # You might want more robust error handling here, e.g., resetting specific keys
-          pass
-     return validated
+    def copy(self):
+        """Copy for command handlers that stage edits before saving."""
+        staged = replace(self)
+        # Don't alias the mutable channel set between the live config and the copy
+        if staged.allowed_channel_ids is not None:
+            staged.allowed_channel_ids = set(staged.allowed_channel_ids)
+        return staged
+
+# Display labels for the !config embed ("hash_size" -> "Hash Size"),
+# precomputed once since the field set is fixed
+_FIELD_LABELS = {f.name: f.name.replace('_', ' ').title() for f in fields(GuildConfig)}
+
+def get_default_guild_config(guild_id):
+    """Returns a GuildConfig with default settings for a guild."""
+    return GuildConfig(hash_db_file=f"{HASH_FILENAME_PREFIX}{guild_id}.db")
+
+def _read_main_config_sync():
+    """Blocking read+parse of the main config file (runs on the executor)."""
+    with open(CONFIG_FILE_PATH, 'rb') as f:
+        return orjson.loads(f.read())
 
 async def load_main_config():
     """Loads the main server_configs.json file into the global cache."""
     global server_configs
     async with config_lock:
-        print(f"DEBUG: Loading main config file: {CONFIG_FILE_PATH}")
+        logger.debug("Loading main config file: %s", CONFIG_FILE_PATH)
         try:
-            with open(CONFIG_FILE_PATH, 'r', encoding='utf-8') as f:
-                loaded_data = json.load(f)
-                if not isinstance(loaded_data, dict):
-                     print(f"Error: Main config file {CONFIG_FILE_PATH} is not a JSON object. Using empty config.", file=sys.stderr)
-                     server_configs = {}
-                     return
-
-                # Validate each guild's config within the loaded data
-                validated_configs = {}
-                for guild_id_str, guild_config_data in loaded_data.items():
-                    try:
-                        guild_id = int(guild_id_str)
-                        # Validate the loaded data for this guild
-                        validated_configs[guild_id] = validate_config_data(guild_config_data)
-                        # Ensure hash_db_file name is consistent with guild_id
-                        validated_configs[guild_id]['hash_db_file'] = f"{HASH_FILENAME_PREFIX}{guild_id}.json"
-                    except ValueError:
-                        print(f"Warning: Invalid guild ID '{guild_id_str}' in config file. Skipping.", file=sys.stderr)
-                server_configs = validated_configs
-                print(f"Successfully loaded configurations for {len(server_configs)} guilds.")
+            loaded_data = await asyncio.get_running_loop().run_in_executor(
+                None, _read_main_config_sync)
+            if not isinstance(loaded_data, dict):
+                logger.error("Main config file %s is not a JSON object. Using empty config.", CONFIG_FILE_PATH)
+                server_configs = {}
+                return
+
+            # Validate each guild's config within the loaded data
+            validated_configs = {}
+            for guild_id_str, guild_config_data in loaded_data.items():
+                try:
+                    guild_id = int(guild_id_str)
+                    # Validate the loaded data for this guild; from_dict
+                    # also pins hash_db_file to the canonical name
+                    validated_configs[guild_id] = GuildConfig.from_dict(guild_id, guild_config_data)
+                except ValueError:
+                    logger.warning("Invalid guild ID '%s' in config file. Skipping.", guild_id_str)
+            server_configs = validated_configs
+            logger.info("Successfully loaded configurations for %d guilds.", len(server_configs))
 
         except FileNotFoundError:
-            print(f"Info: Config file '{CONFIG_FILE_PATH}' not found. Will be created on first save.", file=sys.stderr)
+            logger.info("Config file '%s' not found. Will be created on first save.", CONFIG_FILE_PATH)
             server_configs = {} # Start with empty config if file doesn't exist
-        except json.JSONDecodeError as e:
-            print(f"Error: Could not decode JSON from '{CONFIG_FILE_PATH}'. Check format. Using empty config. Error: {e}", file=sys.stderr)
+        except orjson.JSONDecodeError as e:
+            logger.error("Could not decode JSON from '%s'. Check format. Using empty config. Error: %s", CONFIG_FILE_PATH, e)
             server_configs = {}
         except Exception as e:
-            print(f"Error loading main config file '{CONFIG_FILE_PATH}': {e}. Using empty config.", file=sys.stderr)
-            traceback.print_exc()
+            logger.exception("Error loading main config file '%s'. Using empty config.", CONFIG_FILE_PATH)
             server_configs = {}
 
+def _write_main_config_sync(config_to_save):
+    """Blocking atomic write of the main config file (runs on the executor).
+
+    Writes to a temp file and renames into place so a crash mid-write can
+    never leave a truncated config behind.
+    """
+    tmp_path = CONFIG_FILE_PATH + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(config_to_save, option=orjson.OPT_INDENT_2))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, CONFIG_FILE_PATH)
+
 async def save_main_config():
     """Saves the global server_configs cache to server_configs.json."""
     async with config_lock:
-        print(f"DEBUG: Saving main config file: {CONFIG_FILE_PATH}")
+        logger.debug("Saving main config file: %s", CONFIG_FILE_PATH)
         # Convert guild_id keys back to strings for JSON compatibility
-        config_to_save = {str(gid): data for gid, data in server_configs.items()}
+        config_to_save = {str(gid): cfg.to_dict() for gid, cfg in server_configs.items()}
         try:
-            with open(CONFIG_FILE_PATH, 'w', encoding='utf-8') as f:
-                json.dump(config_to_save, f, indent=4)
-            print(f"DEBUG: Successfully saved main config for {len(config_to_save)} guilds.")
+            # Serialize + fsync on the executor so a large config never
+            # stalls the event loop, matching how the hash store does IO
+            await asyncio.get_running_loop().run_in_executor(
+                None, partial(_write_main_config_sync, config_to_save))
+            logger.debug("Successfully saved main config for %d guilds.", len(config_to_save))
             return True
         except IOError as e:
-            print(f"DEBUG: Error - Could not write to main config file '{CONFIG_FILE_PATH}': {e}", file=sys.stderr)
+            logger.error("Could not write to main config file '%s': %s", CONFIG_FILE_PATH, e)
             return False
         except Exception as e:
-            print(f"DEBUG: Error saving main config file '{CONFIG_FILE_PATH}': {e}", file=sys.stderr)
-            traceback.print_exc()
+            logger.exception("Error saving main config file '%s'", CONFIG_FILE_PATH)
             return False
 
+# Coalesced config persistence: callers that only need the config written
+# out eventually set this event; a background task collapses any burst of
+# requests (e.g. default creation across all guilds at startup) into one
+# write after a short quiet interval.
+CONFIG_SAVE_DELAY = 0.5 # Seconds the saver waits to coalesce further requests
+
+_config_save_requested = asyncio.Event()
+_config_saver_task = None
+
+def schedule_config_save():
+    """Requests a (coalesced) background save of the main config file."""
+    _config_save_requested.set()
+
+async def _config_saver():
+    """Long-running task that batches config-save requests into one write."""
+    while True:
+        await _config_save_requested.wait()
+        # Let a burst of requests accumulate before writing once
+        await asyncio.sleep(CONFIG_SAVE_DELAY)
+        _config_save_requested.clear()
+        try:
+            await save_main_config()
+        except Exception as e:
+            logger.exception("Error in config saver")
+
 def get_guild_config(guild_id):
-    """Gets guild config, ensures defaults exist (incl. new fields)."""
-    global server_configs
-    defaults_needed = False
-    # If guild not in cache, create its default config
-    if guild_id not in server_configs:
-        print(f"DEBUG: No config found for guild {guild_id}. Creating defaults.")
-        server_configs[guild_id] = get_default_guild_config(guild_id)
-        defaults_needed = True
-    else:
-        # If guild exists, check if it has all the latest default keys
-        guild_conf = server_configs[guild_id]
-        default_conf = get_default_guild_config(guild_id)
-        updated = False
-        for key, default_value in default_conf.items():
-            if key not in guild_conf:
-                 print(f"DEBUG: Adding missing default key '{key}' for guild {guild_id}.")
-                 guild_conf[key] = default_value
-                 updated = True
-        # If keys were added, re-validate the whole config dict for the guild
-        if updated:
-             server_configs[guild_id] = validate_config_data(guild_conf)
-             defaults_needed = True # Mark that save is needed
-
-    # If defaults were created or added, schedule a save
-    if defaults_needed:
-        # Use asyncio.create_task to run save_main_config without blocking
-        asyncio.create_task(save_main_config())
-
-    return server_configs[guild_id]
-
-async def save_guild_config(guild_id, guild_config_data):
-     """Updates a specific guild's config in the cache and saves the main file."""
-     global server_configs
-     # Validate before saving
-     server_configs[guild_id] = validate_config_data(guild_config_data)
+    """Gets guild config, creating and persisting defaults on first sight."""
+    # Hot path: one dict probe — every cached entry is a validated GuildConfig
+    guild_conf = server_configs.get(guild_id)
+    if guild_conf is not None:
+        return guild_conf
+    logger.debug("No config found for guild %s. Creating defaults.", guild_id)
+    guild_conf = get_default_guild_config(guild_id)
+    server_configs[guild_id] = guild_conf
+    # Coalesced: many guilds creating defaults at startup produce one write
+    schedule_config_save()
+    return guild_conf
+
+async def save_guild_config(guild_id, guild_config):
+     """Updates a specific guild's config in the cache and schedules a write.
+
+     The in-memory cache is authoritative; the coalescing saver persists
+     it shortly after (and the shutdown hook flushes anything pending),
+     so command handlers don't block on serialization + fsync.
+     """
      # Ensure hash_db_file name is consistent
-     server_configs[guild_id]['hash_db_file'] = f"{HASH_FILENAME_PREFIX}{guild_id}.json"
-     return await save_main_config()
+     guild_config.hash_db_file = f"{HASH_FILENAME_PREFIX}{guild_id}.db"
+     server_configs[guild_id] = guild_config
+     # Rendered !config embed is stale now
+     _EMBED_CACHE.pop(guild_id, None)
+     schedule_config_save()
+     return True
 
 
 # --- Hashing and File I/O Functions ---
 
 def get_hash_file_lock(guild_id):
-    """Gets or creates the asyncio.Lock for a specific guild's hash file."""
-    global hash_file_locks
-    if guild_id not in hash_file_locks:
-        hash_file_locks[guild_id] = asyncio.Lock()
-    return hash_file_locks[guild_id]
+    """Returns the striped lock guarding a specific guild's hash database."""
+    return _HASH_LOCKS[guild_id & (_HASH_LOCK_STRIPES - 1)]
+
+# Reject decompression bombs before PIL allocates pixel storage; opening
+# a larger image raises DecompressionBombError instead of eating RAM.
+Image.MAX_IMAGE_PIXELS = 100_000_000
+
+# Per-thread scratch arrays for calculate_hash_sync. Each executor worker
+# reuses the same pixel/diff buffers across calls instead of allocating
+# two small ndarrays per image.
+_hash_tls = threading.local()
+
+def _hash_buffers(hash_size):
+    """Returns (pixels, diff) scratch arrays for this thread, resizing
+    them when a guild uses a non-default hash_size."""
+    bufs = getattr(_hash_tls, 'bufs', None)
+    if bufs is None or bufs[0].shape[0] != hash_size:
+        bufs = (np.empty((hash_size, hash_size + 1), np.uint8),
+                np.empty((hash_size, hash_size), bool))
+        _hash_tls.bufs = bufs
+    return bufs
 
 def calculate_hash_sync(image_bytes, hash_size):
-    """Synchronous hash calculation."""
+    """
+    Synchronous dHash (difference hash) calculation, returned as an int.
+    Implemented directly with Pillow + NumPy: grayscale, resize to
+    (hash_size+1, hash_size), compare adjacent columns, pack the bits.
+    Bit order matches the hex strings imagehash produced, so existing
+    databases stay comparable.
+    """
     try:
         img = Image.open(io.BytesIO(image_bytes))
-        # Using dhash (difference hash)
-        return imagehash.dhash(img, hash_size=hash_size)
+        # For JPEGs, draft mode decodes at 1/2, 1/4 or 1/8 resolution in
+        # the DCT domain — far cheaper than a full decode we'd immediately
+        # shrink anyway. No-op for other formats.
+        img.draft('L', (hash_size * 8, hash_size * 8))
+        # LANCZOS matches the resampling imagehash used, keeping hashes
+        # bit-identical to ones computed by earlier versions
+        img = img.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels, diff = _hash_buffers(hash_size)
+        pixels[:] = np.frombuffer(img.tobytes(), np.uint8).reshape(hash_size, hash_size + 1)
+        # Difference hash: is each pixel brighter than its left neighbour?
+        np.greater(pixels[:, 1:], pixels[:, :-1], out=diff)
+        return int.from_bytes(np.packbits(diff).tobytes(), 'big')
     except UnidentifiedImageError:
-        print("DEBUG: Error - Cannot identify image file format from bytes.", file=sys.stderr)
+        logger.debug("Cannot identify image file format from bytes.")
         return None
-    except Exception as e:
-        # Log other potential image processing errors
-        print(f"DEBUG: Error processing image from bytes: {e}", file=sys.stderr)
-        traceback.print_exc()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        # Narrow catch: truncated/corrupt data and bomb rejections are
+        # expected inputs, while real bugs (and SystemExit/KeyboardInterrupt
+        # during shutdown) propagate instead of being swallowed
+        logger.debug("Error processing image from bytes: %s", e)
         return None
 
-async def calculate_hash(image_bytes, hash_size, loop):
+# Process pool for CPU-heavy image decode + hashing. PIL and the numpy
+# dhash math hold the GIL for part of their work, so threads serialize
+# under concurrent uploads; separate processes scale with cores. Created
+# in __main__ (must not run at import in child processes); None falls
+# back to the default thread pool.
+HASH_POOL = None
+
+async def calculate_hash(image_bytes, hash_size):
     """Calculates the perceptual hash asynchronously using an executor."""
     func = partial(calculate_hash_sync, image_bytes, hash_size)
-    # Run the synchronous function in the default thread pool executor
-    hash_value = await loop.run_in_executor(None, func)
-    return hash_value
+    # Run the synchronous function in the hash process pool when available
+    # (to_thread can't target a specific pool, so this one keeps the loop API)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(HASH_POOL, func)
 
 def load_hashes_sync(db_file):
-    """Synchronous hash loading from a specific file."""
+    """Synchronous loading of a legacy JSON hash file (pre-SQLite).
+
+    Kept for the one-time migration performed when a guild's SQLite
+    database is first created.
+    """
     if not os.path.exists(db_file):
         return {} # Return empty if file doesn't exist
     try:
-        with open(db_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(db_file, 'rb') as f:
+            data = orjson.loads(f.read())
         # Basic validation: ensure it's a dictionary
         if not isinstance(data, dict):
-            print(f"Warning: Hash file '{db_file}' content is not a dictionary. Returning empty.", file=sys.stderr)
+            logger.warning("Hash file '%s' content is not a dictionary. Returning empty.", db_file)
             return {}
 
+        # Files written by late JSON-era versions carry a version tag; its
+        # presence settles the format question without walking the dict
+        if data.pop('__version__', None) is not None:
+            return data
+
         # Check format (best effort) - Helps warn about old format data
         is_new_format_likely = False
         if data: # Only check if data is not empty
@@ -252,129 +414,467 @@ def load_hashes_sync(db_file):
                 if is_new_format_likely: break
 
         if not is_new_format_likely and data:
-             print(f"Warning: Hash file '{db_file}' might be in old format (expected {{'hash': ..., 'user_id': ...}}). Owner checks may be unreliable.", file=sys.stderr)
+             logger.warning("Hash file '%s' might be in old format (expected {'hash': ..., 'user_id': ...}). Owner checks may be unreliable.", db_file)
 
-        # print(f"DEBUG: Loaded hashes from '{db_file}'.") # Can be noisy
         return data
-    except json.JSONDecodeError as e:
-        print(f"DEBUG: Error decoding JSON from hash db '{db_file}': {e}", file=sys.stderr)
+    except orjson.JSONDecodeError as e:
+        logger.error("Error decoding JSON from hash db '%s': %s", db_file, e)
         return {}
     except Exception as e:
-        print(f"DEBUG: Error loading hash db '{db_file}': {e}", file=sys.stderr)
-        traceback.print_exc()
+        logger.exception("Error loading hash db '%s'", db_file)
         return {}
 
-def save_hashes_sync(hashes_dict, db_file):
-    """Synchronous hash saving to a specific file."""
+# --- SQLite Hash Database ---
+# One database per guild (same per-guild file convention as before).
+# Inserts are O(1) appends instead of full-file JSON rewrites, and the
+# fragile old-vs-new JSON format sniffing only runs during migration.
+
+_HASHES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    identifier TEXT PRIMARY KEY,
+    hash BLOB NOT NULL,
+    user_id INTEGER,
+    channel_id TEXT,
+    message_id INTEGER
+)
+"""
+
+def _identifier_message_id(identifier):
+    """Best-effort message ID from a legacy '<message_id>-<filename>' key."""
+    try:
+        return int(identifier.split('-', 1)[0])
+    except (ValueError, AttributeError):
+        return None
+
+def _hash_blob(hash_int, hash_size):
+    """Packs a hash int into a word-aligned big-endian BLOB for disk.
+
+    Sized from whichever is wider, the configured hash_size or the int
+    itself, so hashes written before a hash_size change (or legacy files
+    holding mixed sizes) can never overflow to_bytes.
+    """
+    bits = hash_size * hash_size
+    words = max(1, (bits + 63) // 64, (hash_int.bit_length() + 63) // 64)
+    return hash_int.to_bytes(words * 8, 'big')
+
+def _flatten_legacy_hashes(data):
+    """
+    Converts a legacy JSON hash dict (flat for server scope, nested one
+    level for channel scope) into (identifier, hash_int, user_id,
+    channel_id) rows. Unusable entries are skipped, as before.
+    """
+    rows = []
+    if not isinstance(data, dict):
+        return rows
+    for key, value in data.items():
+        hash_int, user_id = _hash_entry_to_int(value)
+        if hash_int is not None:
+            rows.append((key, hash_int, user_id, None, _identifier_message_id(key)))
+            continue
+        if isinstance(value, dict): # Channel-scoped sub-dictionary
+            for sub_key, sub_value in value.items():
+                hash_int, user_id = _hash_entry_to_int(sub_value)
+                if hash_int is not None:
+                    rows.append((sub_key, hash_int, user_id, key, _identifier_message_id(sub_key)))
+    return rows
+
+def load_store_sync(db_file, legacy_json_file, hash_size):
+    """
+    Opens (creating if needed) a guild's SQLite hash database and returns
+    all rows as (identifier, hash_int, user_id, channel_id) tuples. If the
+    database is empty and a legacy JSON file exists, its contents are
+    migrated in first.
+    """
     try:
-        with open(db_file, 'w', encoding='utf-8') as f:
-            json.dump(hashes_dict, f, indent=4)
-        # print(f"DEBUG: Saved hashes to '{db_file}'.") # Can be noisy
+        conn = sqlite3.connect(db_file)
+        try:
+            conn.execute(_HASHES_SCHEMA)
+            # Databases created before the message_id column: add it and
+            # backfill once from the identifier prefix
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(hashes)")]
+            if 'message_id' not in columns:
+                conn.execute("ALTER TABLE hashes ADD COLUMN message_id INTEGER")
+                backfill = [(_identifier_message_id(identifier), identifier)
+                            for (identifier,) in conn.execute("SELECT identifier FROM hashes")]
+                conn.executemany("UPDATE hashes SET message_id = ? WHERE identifier = ?", backfill)
+                conn.commit()
+            count = conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+            if count == 0 and os.path.exists(legacy_json_file):
+                legacy_rows = _flatten_legacy_hashes(load_hashes_sync(legacy_json_file))
+                if legacy_rows:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                        [(i, _hash_blob(h, hash_size), u, c, m) for i, h, u, c, m in legacy_rows])
+                    conn.commit()
+                    logger.info("Migrated %d hashes from '%s' to '%s'.", len(legacy_rows), legacy_json_file, db_file)
+            return [(identifier, int.from_bytes(blob, 'big'), user_id, channel_id, message_id)
+                    for identifier, blob, user_id, channel_id, message_id in conn.execute(
+                        "SELECT identifier, hash, user_id, channel_id, message_id FROM hashes")]
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.error("Error loading hash db '%s': %s", db_file, e)
+        return []
+
+def append_rows_sync(db_file, rows, hash_size):
+    """Appends new hash rows to a guild's SQLite database."""
+    try:
+        conn = sqlite3.connect(db_file)
+        try:
+            conn.execute(_HASHES_SCHEMA)
+            conn.executemany(
+                "INSERT OR IGNORE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                [(i, _hash_blob(h, hash_size), u, c, m) for i, h, u, c, m in rows])
+            conn.commit()
+        finally:
+            conn.close()
         return True
-    except IOError as e:
-         print(f"DEBUG: Error - Could not write to hash file '{db_file}': {e}", file=sys.stderr)
-         return False
-    except Exception as e:
-        print(f"DEBUG: Error saving hash db '{db_file}': {e}", file=sys.stderr)
-        traceback.print_exc()
+    except sqlite3.Error as e:
+        logger.error("Error appending to hash db '%s': %s", db_file, e)
         return False
 
-async def load_guild_hashes(guild_id, loop):
-    """Loads the hash database for a specific guild using its lock."""
+# --- Resident Per-Guild Hash Stores ---
+
+class GuildStore:
+    """
+    Resident hash store for one guild, backed by its append-only SQLite
+    database. Rows are held as (identifier, hash_int, user_id, channel_id,
+    message_id) tuples with lazily built per-scope HashIndexes; inserts queue rows
+    that the background flusher appends in batches.
+    """
+    def __init__(self, guild_id, rows=None, hash_size=8, db_file=None):
+        self.guild_id = guild_id
+        self.hash_size = hash_size
+        self.db_file = db_file          # remembered so shutdown flush needs no config lookup
+        self.dirty = False              # True when rows are pending append
+        self.pending = []               # rows not yet written to SQLite
+        self._rows = list(rows) if rows else []
+        self._server_index = None       # built on first server-scope query
+        self._channel_indexes = {}      # {channel_id: HashIndex}
+
+    def index_for(self, scope, channel_id):
+        """Returns (building lazily) the HashIndex for the requested scope."""
+        if scope == "channel":
+            index = self._channel_indexes.get(channel_id)
+            if index is None:
+                index = HashIndex(self.hash_size)
+                # Rows keep channel keys as strings (SQLite TEXT); compare
+                # against one str() computed here, not per message
+                channel_id_str = str(channel_id)
+                for identifier, hash_int, user_id, channel_key, message_id in self._rows:
+                    if channel_key == channel_id_str:
+                        index.add(identifier, hash_int, user_id, message_id)
+                self._channel_indexes[channel_id] = index
+            return index
+        if self._server_index is None:
+            index = HashIndex(self.hash_size)
+            for identifier, hash_int, user_id, _channel_key, message_id in self._rows:
+                index.add(identifier, hash_int, user_id, message_id)
+            self._server_index = index
+        return self._server_index
+
+    def add(self, scope, channel_id, identifier, hash_int, user_id, message_id=None):
+        """Queues a new hash row and updates any already-built index."""
+        channel_key = str(channel_id) if scope == "channel" else None
+        row = (identifier, hash_int, user_id, channel_key, message_id)
+        self._rows.append(row)
+        self.pending.append(row)
+        if self._server_index is not None:
+            self._server_index.add(identifier, hash_int, user_id, message_id)
+        if channel_key is not None:
+            index = self._channel_indexes.get(channel_id)
+            if index is not None: index.add(identifier, hash_int, user_id, message_id)
+        self.dirty = True
+
+guild_stores = {} # {guild_id: GuildStore}
+
+async def get_guild_store(guild_id):
+    """Returns the resident store for a guild, loading it on first use."""
+    store = guild_stores.get(guild_id)
+    if store is not None:
+        return store
     guild_config = get_guild_config(guild_id)
-    db_file = guild_config['hash_db_file']
+    db_file = guild_config.hash_db_file
+    legacy_json_file = f"{HASH_FILENAME_PREFIX}{guild_id}.json"
+    hash_size = guild_config.hash_size
     lock = get_hash_file_lock(guild_id)
     async with lock:
-        # print(f"DEBUG: Loading hashes for guild {guild_id} from {db_file}...") # Can be noisy
-        func = partial(load_hashes_sync, db_file)
-        hashes_dict = await loop.run_in_executor(None, func)
-    return hashes_dict
-
-async def save_guild_hashes(guild_id, hashes_dict, loop):
-    """Saves the hash database for a specific guild using its lock."""
-    guild_config = get_guild_config(guild_id)
-    db_file = guild_config['hash_db_file']
+        # Re-check: another coroutine may have loaded it while we waited
+        store = guild_stores.get(guild_id)
+        if store is None:
+            rows = await asyncio.to_thread(load_store_sync, db_file, legacy_json_file, hash_size)
+            store = GuildStore(guild_id, rows, hash_size, db_file)
+            guild_stores[guild_id] = store
+    return store
+
+async def save_guild_store(guild_id):
+    """Appends a guild store's pending rows to its database file."""
+    store = guild_stores.get(guild_id)
+    if store is None or not store.pending:
+        return True
     lock = get_hash_file_lock(guild_id)
     async with lock:
-        # print(f"DEBUG: Saving hashes for guild {guild_id} to {db_file}...") # Can be noisy
-        func = partial(save_hashes_sync, hashes_dict, db_file)
-        success = await loop.run_in_executor(None, func)
+        batch = store.pending[:]
+        success = await asyncio.to_thread(append_rows_sync, store.db_file, batch, store.hash_size)
+        if success:
+            # New rows may have arrived while the append ran
+            del store.pending[:len(batch)]
+            store.dirty = bool(store.pending)
     return success
 
-# --- Duplicate Finding (Scope Aware, Returns UserID) ---
-def find_duplicates_sync(new_image_hash, stored_hashes_dict, threshold, scope, channel_id_str):
-    """
-    Finds duplicates based on scope. Returns original user ID if found.
-    Handles both old ({id: hash}) and new ({id: {hash:..., user_id:...}}) formats.
-    """
-    duplicates = []
-    if new_image_hash is None: return duplicates
-
-    hashes_to_check = {}
-    # Select the correct dictionary portion based on scope
-    if scope == "server":
-        if isinstance(stored_hashes_dict, dict): hashes_to_check = stored_hashes_dict
-    elif scope == "channel":
-        if isinstance(stored_hashes_dict, dict):
-            # Get the specific channel's hash dict, default to empty if channel not found
-            channel_data = stored_hashes_dict.get(channel_id_str, {})
-            # Ensure the channel data itself is a dictionary
-            if isinstance(channel_data, dict): hashes_to_check = channel_data
-    else:
-        print(f"Error: Unknown scope '{scope}' in find_duplicates_sync.", file=sys.stderr)
-        return duplicates # Unknown scope
+# --- Background Hash-DB Flusher ---
+# Inserts only queue rows; this task coalesces them into one batched
+# append per guild per interval.
 
-    # Iterate through the selected hashes
-    for identifier, hash_data in hashes_to_check.items():
-        stored_hash_str = None
-        original_user_id = None # Default to None
+HASH_FLUSH_INTERVAL = 5.0 # Seconds between background flush passes
 
-        # Determine hash string and user ID based on stored format
-        if isinstance(hash_data, dict) and 'hash' in hash_data: # New format
-            stored_hash_str = hash_data.get('hash')
-            original_user_id = hash_data.get('user_id') # Get user_id if present
-        elif isinstance(hash_data, str): # Old format (assume it's just the hash string)
-            stored_hash_str = hash_data
-            # original_user_id remains None
+_hash_flusher_task = None
 
-        # Skip if we couldn't extract a hash string
-        if stored_hash_str is None: continue
+async def flush_dirty_stores():
+    """Appends pending rows for every store that has some."""
+    for guild_id, store in list(guild_stores.items()):
+        if store.dirty:
+            await save_guild_store(guild_id)
 
+async def _hash_flusher():
+    """Long-running task that periodically flushes dirty hash stores."""
+    while True:
+        await asyncio.sleep(HASH_FLUSH_INTERVAL)
         try:
-            # Compare hashes
-            stored_hash = imagehash.hex_to_hash(stored_hash_str)
-            distance = new_image_hash - stored_hash
-            # Check if within threshold
-            if distance <= threshold:
-                original_message_id = None
-                # Try to extract original message ID from identifier (best effort)
-                try: original_message_id = int(identifier.split('-')[0])
-                except: pass # Ignore if format is different or extraction fails
-                # Append match data including original user ID
-                duplicates.append({
-                    'identifier': identifier,
-                    'distance': distance,
-                    'original_message_id': original_message_id,
-                    'original_user_id': original_user_id # Will be None if not found/old format
-                })
-        except ValueError:
-             # Silently ignore errors converting hex string to hash
-             pass
+            await flush_dirty_stores()
         except Exception as e:
-            # Log other comparison errors
-            print(f"DEBUG: Error comparing hash for identifier '{identifier}': {e}", file=sys.stderr)
+            logger.exception("Error in hash flusher")
 
-    # Sort matches by distance (closest first)
-    duplicates.sort(key=lambda x: x['distance'])
-    return duplicates
+def save_main_config_blocking():
+    """Last-chance synchronous config write used at shutdown."""
+    if not _config_save_requested.is_set():
+        return
+    try:
+        _write_main_config_sync({str(gid): cfg.to_dict() for gid, cfg in server_configs.items()})
+        _config_save_requested.clear()
+    except Exception:
+        logger.exception("Error writing main config during shutdown")
+
+def flush_dirty_stores_blocking():
+    """Last-chance synchronous flush used at shutdown."""
+    for store in list(guild_stores.values()):
+        if store.pending and store.db_file:
+            if append_rows_sync(store.db_file, store.pending, store.hash_size):
+                store.pending.clear()
+                store.dirty = False
+
+# --- In-Memory Hash Index (Vectorized Duplicate Scan) ---
+
+# 256-entry byte popcount lookup table used to turn the XOR of two packed
+# hashes into a Hamming distance with a single vectorized pass.
+_POPCOUNT_LUT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# NumPy >= 2.0 exposes the hardware POPCNT instruction directly; prefer it
+# over the byte LUT when present.
+_HAS_BITWISE_COUNT = hasattr(np, 'bitwise_count')
+
+def _popcount_rows(xored):
+    """Hamming distance per row of an (N, words) uint64 XOR result."""
+    if _HAS_BITWISE_COUNT:
+        return np.bitwise_count(xored).sum(axis=1, dtype=np.uint16)
+    return _POPCOUNT_LUT[xored.view(np.uint8)].reshape(xored.shape[0], -1).sum(axis=1, dtype=np.uint16)
+
+# Below this many entries the vectorized linear scan beats the tree walk,
+# so small indexes skip the BK-tree entirely.
+_BKTREE_MIN_SIZE = 256
+
+class _BKTree:
+    """
+    Minimal BK-tree over (hash_int, row) pairs keyed on Hamming distance.
+    For small thresholds the triangle inequality prunes most of the tree,
+    giving sub-linear lookups once an index grows past a few hundred rows.
+    Nodes are plain [hash_int, row, children] lists to keep them light.
+    """
+    __slots__ = ('_root',)
+
+    def __init__(self):
+        self._root = None
+
+    def add(self, hash_int, row):
+        """Inserts one entry, descending along matching-distance edges."""
+        if self._root is None:
+            self._root = [hash_int, row, {}]
+            return
+        node = self._root
+        while True:
+            dist = (hash_int ^ node[0]).bit_count()
+            child = node[2].get(dist)
+            if child is None:
+                node[2][dist] = [hash_int, row, {}]
+                return
+            node = child
+
+    def find(self, hash_int, threshold):
+        """Returns [(distance, row), ...] for all entries within threshold."""
+        if self._root is None:
+            return []
+        results = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            dist = (hash_int ^ node[0]).bit_count()
+            if dist <= threshold:
+                results.append((dist, node[1]))
+            # Triangle inequality: only edges in [dist-t, dist+t] can lead
+            # to entries within the threshold
+            lo = dist - threshold
+            hi = dist + threshold
+            for edge, child in node[2].items():
+                if lo <= edge <= hi:
+                    stack.append(child)
+        return results
+
+class HashIndex:
+    """
+    Column-oriented in-memory index of stored hashes for one scope
+    (whole server, or a single channel). Hashes are kept as integers and
+    packed into a contiguous numpy uint64 array so the duplicate scan is
+    one vectorized XOR + popcount over all entries instead of a Python
+    loop that re-parses hex strings per entry.
+    """
+    def __init__(self, hash_size=8):
+        self.hash_size = hash_size
+        # Number of 64-bit words needed per hash (1 for the default 8x8 = 64 bits)
+        bits = hash_size * hash_size
+        self.words = max(1, (bits + 63) // 64)
+        self.identifiers = []   # parallel to rows of the packed array
+        self.user_ids = []      # original poster IDs (None for legacy entries)
+        self.message_ids = []   # original message IDs (None when unknown)
+        self._hash_ints = []    # hashes as plain Python ints
+        self._packed = None     # lazily (re)built numpy view of _hash_ints
+        self._bktree = None     # lazily built BK-tree (large indexes only)
+        self._tree_rows = 0     # rows already inserted into the tree
+        self._exact = {}        # {hash_int: [row, ...]} for distance-0 lookups
+
+    def __len__(self):
+        return len(self._hash_ints)
+
+    def add(self, identifier, hash_int, user_id, message_id=None):
+        """Appends one entry and invalidates the packed array."""
+        self._exact.setdefault(hash_int, []).append(len(self._hash_ints))
+        self.identifiers.append(identifier)
+        self.user_ids.append(user_id)
+        self.message_ids.append(message_id)
+        self._hash_ints.append(hash_int)
+        # Hashes written under a larger hash_size widen the packing so
+        # _pack_int never silently truncates them
+        needed = (hash_int.bit_length() + 63) // 64
+        if needed > self.words:
+            self.words = needed
+        self._packed = None
+
+    def exact_rows(self, hash_int):
+        """Rows storing exactly this hash (the threshold-0 answer)."""
+        return self._exact.get(hash_int, [])
+
+    def _pack_int(self, hash_int):
+        """Splits an arbitrary-width hash int into big-endian uint64 words."""
+        mask = 0xFFFFFFFFFFFFFFFF
+        return [(hash_int >> (64 * (self.words - 1 - w))) & mask for w in range(self.words)]
+
+    def packed(self):
+        """Returns the (N, words) uint64 matrix, rebuilding it if stale."""
+        if self._packed is None:
+            self._packed = np.array(
+                [self._pack_int(h) for h in self._hash_ints], dtype=np.uint64
+            ).reshape(len(self._hash_ints), self.words)
+        return self._packed
+
+    def query_row(self, hash_int):
+        """Packs a query hash into a (words,) uint64 row for broadcasting."""
+        # A query wider than the stored rows (hash_size raised since they
+        # were written) widens the whole index once instead of truncating
+        needed = (hash_int.bit_length() + 63) // 64
+        if needed > self.words:
+            self.words = needed
+            self._packed = None
+        return np.array(self._pack_int(hash_int), dtype=np.uint64)
+
+    def bktree(self):
+        """Returns the BK-tree, building it on first use and catching up
+        on rows added since the last query."""
+        if self._bktree is None:
+            self._bktree = _BKTree()
+        while self._tree_rows < len(self._hash_ints):
+            self._bktree.add(self._hash_ints[self._tree_rows], self._tree_rows)
+            self._tree_rows += 1
+        return self._bktree
+
+def _hash_entry_to_int(hash_data):
+    """
+    Extracts (hash_int, user_id) from a stored entry. Handles both the old
+    format (bare hex string) and the new format ({'hash': ..., 'user_id': ...}).
+    Returns (None, None) if the entry is unusable.
+    """
+    stored_hash_str = None
+    user_id = None
+    if isinstance(hash_data, dict) and 'hash' in hash_data:
+        stored_hash_str = hash_data.get('hash')
+        user_id = hash_data.get('user_id')
+    elif isinstance(hash_data, str):
+        stored_hash_str = hash_data
+    if not isinstance(stored_hash_str, str):
+        return None, None
+    try:
+        return int(stored_hash_str, 16), user_id
+    except ValueError:
+        return None, None
+
+# --- Duplicate Finding (Index Scan, Returns UserID) ---
+def scan_index(new_image_hash, index, threshold):
+    """Vectorized Hamming scan of a HashIndex. Returns sorted match dicts."""
+    if index is None or len(index) == 0: return []
+
+    # Hashes are plain ints end to end now; tolerate hex strings for safety
+    if isinstance(new_image_hash, int):
+        query_int = new_image_hash
+    else:
+        try:
+            query_int = int(str(new_image_hash), 16)
+        except (TypeError, ValueError):
+            return []
+
+    if threshold <= 0:
+        # Exact-match mode never needs a distance scan: the index keeps a
+        # hash -> rows dict, so this is a single set-style probe
+        hits = [(0, row) for row in index.exact_rows(query_int)]
+    elif len(index) >= _BKTREE_MIN_SIZE:
+        # Large index: sub-linear BK-tree walk pruned by the threshold
+        hits = index.bktree().find(query_int, threshold)
+    else:
+        # Small index: one XOR over the whole matrix, then a vectorized
+        # popcount per row — cheaper than the tree walk at this size.
+        # query_row first: it may widen the index, so packed() must be
+        # fetched after it or a stale narrow matrix gets XORed
+        query_row = index.query_row(query_int)
+        xored = index.packed() ^ query_row
+        dists = _popcount_rows(xored)
+        rows = np.nonzero(dists <= threshold)[0]
+        hits = [(int(dists[row]), int(row)) for row in rows]
+    if not hits: return []
+
+    # Sort hits by distance (closest first) before gathering metadata
+    hits.sort()
 
-async def find_duplicates(new_image_hash, stored_hashes_dict, threshold, scope, channel_id, loop):
-    """Async wrapper for duplicate finding."""
-    # Pass necessary arguments to the synchronous function
-    func = partial(find_duplicates_sync, new_image_hash, stored_hashes_dict, threshold, scope, str(channel_id))
-    duplicates = await loop.run_in_executor(None, func)
+    duplicates = []
+    for distance, row in hits:
+        duplicates.append({
+            'identifier': index.identifiers[row],
+            'distance': distance,
+            'original_message_id': index.message_ids[row],  # None when unknown
+            'original_user_id': index.user_ids[row]  # None for legacy entries
+        })
     return duplicates
 
+async def find_duplicates(new_image_hash, index, threshold):
+    """Async wrapper for the index scan."""
+    return await asyncio.to_thread(scan_index, new_image_hash, index, threshold)
+
 
 # --- Discord Bot Implementation ---
 # Define necessary intents for bot operation
@@ -391,24 +891,127 @@ bot = commands.Bot(command_prefix=DEFAULT_COMMAND_PREFIX, intents=intents)
 @bot.event
 async def on_ready():
     """Called when the bot logs in and is ready."""
-    print(f'--- Logged in as {bot.user.name} (ID: {bot.user.id}) ---')
-    print(f'--- Command Prefix: {bot.command_prefix} ---')
+    logger.info('--- Logged in as %s (ID: %s) ---', bot.user.name, bot.user.id)
+    logger.info('--- Command Prefix: %s ---', bot.command_prefix)
     # Load configurations for all guilds the bot is currently in
     await load_main_config()
-    print(f'--- Ready for {len(bot.guilds)} guilds ---')
-    # Ensure config entries exist for all guilds upon ready
+    logger.info('--- Ready for %d guilds ---', len(bot.guilds))
+    # Start the persistence tasks before any per-guild work so a failure
+    # preloading one guild can't leave the whole bot without them
+    # Background flusher that persists dirty hash stores
+    global _hash_flusher_task
+    if _hash_flusher_task is None or _hash_flusher_task.done():
+        _hash_flusher_task = asyncio.create_task(_hash_flusher())
+    # Coalescing config saver
+    global _config_saver_task
+    if _config_saver_task is None or _config_saver_task.done():
+        _config_saver_task = asyncio.create_task(_config_saver())
+    # Ensure config entries exist and hash stores are preloaded for all
+    # guilds; one bad database only costs that guild its preload (the
+    # first message there retries via get_guild_store)
     for guild in bot.guilds:
          _ = get_guild_config(guild.id) # This call ensures defaults are created if needed
-    print('------')
+         try:
+             await get_guild_store(guild.id)
+         except Exception:
+             logger.exception("Failed to preload hash store for guild %s", guild.id)
+    logger.info('------')
 
 @bot.event
 async def on_guild_join(guild):
      """Called when the bot joins a new guild."""
-     print(f"Joined new guild: {guild.name} (ID: {guild.id})")
-     # Ensure a default config exists for this new guild
+     logger.info("Joined new guild: %s (ID: %s)", guild.name, guild.id)
+     # Ensure a default config exists for this new guild; get_guild_config
+     # schedules the coalesced save that persists the new entry
      _ = get_guild_config(guild.id)
-     # Save the main config file immediately to persist the new entry
-     await save_main_config()
+     # Preload an (empty) hash store so the first message doesn't pay for it
+     await get_guild_store(guild.id)
+
+# --- Per-Guild Image Work Queues ---
+# on_message only enqueues; one worker task per guild drains its queue so
+# a burst in one guild can't head-of-line block the gateway handler or
+# other guilds' processing.
+
+IMAGE_QUEUE_MAXSIZE = 128 # Per-guild backlog cap; overflow is dropped with a warning
+
+_image_queues = {}  # {guild_id: asyncio.Queue}
+_image_workers = {} # {guild_id: asyncio.Task}
+
+def enqueue_image_work(guild_id, message, image_attachments, guild_config):
+    """Queues one message's image work, spawning the guild worker lazily."""
+    queue = _image_queues.get(guild_id)
+    if queue is None:
+        queue = asyncio.Queue(maxsize=IMAGE_QUEUE_MAXSIZE)
+        _image_queues[guild_id] = queue
+        _image_workers[guild_id] = asyncio.create_task(_image_worker(guild_id, queue))
+    try:
+        queue.put_nowait((message, image_attachments, guild_config))
+    except asyncio.QueueFull:
+        logger.warning("[G:%s] Image work queue full (%d items); dropping message %s.",
+                       guild_id, IMAGE_QUEUE_MAXSIZE, message.id)
+
+async def _image_worker(guild_id, queue):
+    """Long-running task that processes one guild's image messages in order."""
+    while True:
+        message, image_attachments, guild_config = await queue.get()
+        try:
+            await process_image_message(message, image_attachments, guild_config)
+        except Exception:
+            logger.exception("[G:%s] Error in image worker for message %s", guild_id, message.id)
+        finally:
+            queue.task_done()
+
+# dHash needs at most (hash_size + 1) pixels of detail per edge, so a
+# bounded thumbnail from Discord's media proxy carries all the signal the
+# hash uses while cutting download bytes 50-100x for typical photos.
+# 256 px leaves generous margin even for hash_size 16.
+_THUMBNAIL_EDGE = 256
+
+def _thumbnail_url(attachment):
+    """Media-proxy URL for a downscaled copy, or None to fetch the original.
+
+    Returns None when the proxy can't help: unknown dimensions, images
+    already at or below the thumbnail size, or no proxy URL at all.
+    """
+    width, height = attachment.width, attachment.height
+    if not attachment.proxy_url or not width or not height:
+        return None
+    longest = max(width, height)
+    if longest <= _THUMBNAIL_EDGE:
+        return None
+    # The proxy resizes to the exact dimensions given, so preserve aspect
+    scale = _THUMBNAIL_EDGE / longest
+    new_w = max(1, round(width * scale))
+    new_h = max(1, round(height * scale))
+    sep = '&' if '?' in attachment.proxy_url else '?'
+    return f"{attachment.proxy_url}{sep}width={new_w}&height={new_h}"
+
+async def _download_and_hash(attachment, hash_size, guild_id):
+    """Downloads one image attachment and hashes it.
+
+    Returns (attachment, hash_int) — hash_int is None when the download
+    or the hash failed. Safe to run concurrently for several attachments.
+    """
+    try:
+        image_bytes = None
+        thumb_url = _thumbnail_url(attachment)
+        if thumb_url is not None:
+            try:
+                image_bytes = await bot.http.get_from_cdn(thumb_url)
+            except discord.HTTPException:
+                # Proxy can refuse some formats/sizes; fall back to the original
+                logger.debug("[G:%s] Thumbnail fetch failed for '%s'; downloading original.", guild_id, attachment.filename)
+        if image_bytes is None:
+            # use_cached serves repeat downloads from Discord's CDN cache
+            image_bytes = await attachment.read(use_cached=True)
+        return attachment, await calculate_hash(image_bytes, hash_size)
+    except discord.HTTPException as e:
+        # Handle potential errors downloading the attachment
+        logger.warning("[G:%s] HTTP error downloading attachment '%s': %s", guild_id, attachment.filename, e)
+    except Exception:
+        # Catch any other unexpected errors during download/hash
+        logger.exception("[G:%s] Error processing attachment '%s'", guild_id, attachment.filename)
+    return attachment, None
 
 @bot.event
 async def on_message(message):
@@ -417,209 +1020,293 @@ async def on_message(message):
     if message.guild is None or message.author == bot.user or message.author.bot:
         return
 
-    # Allow commands library to process potential commands first
-    await bot.process_commands(message)
+    # Commands only ever start with the prefix; skip the (fairly expensive)
+    # command dispatch for the vast majority of messages that don't
+    if message.content.startswith(bot.command_prefix):
+        await bot.process_commands(message)
+        # Check if the message was actually processed as a valid command
+        ctx = await bot.get_context(message)
+        # If it was a command, don't proceed with image checking for this message
+        if ctx.valid:
+            return
 
-    # Check if the message was actually processed as a valid command
-    ctx = await bot.get_context(message)
-    # If it was a command, don't proceed with image checking for this message
-    if ctx.valid:
+    # --- Image Processing Logic (Only if it wasn't a command) ---
+    # Cheapest check first: most messages are text-only and need no
+    # config lookup at all
+    if not message.attachments:
         return
 
-    # --- Image Processing Logic (Only if it wasn't a command) ---
     guild_id = message.guild.id
     channel_id = message.channel.id
-    channel_id_str = str(channel_id) # Use string for JSON keys if needed later
     current_user_id = message.author.id
     # Get the configuration specific to this guild
     guild_config = get_guild_config(guild_id)
 
-    # Extract relevant settings from the guild's config
-    allowed_channel_ids = guild_config.get('allowed_channel_ids')
-    current_scope = guild_config.get('duplicate_scope', 'server') # Default to server
-    current_mode = guild_config.get('duplicate_check_mode', 'strict') # Default to strict
-    current_hash_size = guild_config.get('hash_size', 8) # Default hash size
-    current_similarity_threshold = guild_config.get('similarity_threshold', 5) # Default threshold
-    react_to_duplicates = guild_config.get('react_to_duplicates', True)
-    delete_duplicates = guild_config.get('delete_duplicates', False)
-    duplicate_reaction_emoji = guild_config.get('duplicate_reaction_emoji', '⚠️')
-
     # Check if processing should happen in this channel
+    allowed_channel_ids = guild_config.allowed_channel_ids
     if allowed_channel_ids and channel_id not in allowed_channel_ids:
         return # Silently ignore if channel is not allowed
 
-    # Check if there are attachments to process
-    if not message.attachments:
+    # Collect image attachments worth processing
+    image_attachments = []
+    for attachment in message.attachments:
+        # Check if the attachment is a static image format worth hashing
+        if attachment.content_type in HASHABLE_CONTENT_TYPES:
+            # Reject oversize uploads before downloading a single byte;
+            # attachment.size comes with the message event
+            if attachment.size and attachment.size > MAX_IMAGE_BYTES:
+                logger.debug("[G:%s] Skipping oversize attachment '%s' (%d bytes).", guild_id, attachment.filename, attachment.size)
+                continue
+            image_attachments.append(attachment)
+    if not image_attachments:
         return
 
-    # print(f"DEBUG: [G:{guild_id} C:{channel_id}] Msg with attachments received.") # Less verbose
+    # Hand the heavy work to this guild's worker so the gateway event
+    # handler returns immediately; guilds never block each other
+    enqueue_image_work(guild_id, message, image_attachments, guild_config)
 
-    loop = asyncio.get_running_loop()
-    # Load the hash database specific to this guild
-    stored_hashes = await load_guild_hashes(guild_id, loop)
-    db_updated = False # Flag to track if the hash DB needs saving
-
-    # Process each attachment
-    for i, attachment in enumerate(message.attachments):
-        # Check if the attachment is an image
-        if attachment.content_type and attachment.content_type.startswith('image/'):
-            try:
-                # Download image bytes
-                image_bytes = await attachment.read()
-                # Calculate its hash
-                new_hash = await calculate_hash(image_bytes, current_hash_size, loop)
-                # Skip if hashing failed
-                if new_hash is None: continue
-
-                # Find potential duplicates based on scope
-                duplicate_matches = await find_duplicates(
-                    new_hash, stored_hashes, current_similarity_threshold,
-                    current_scope, channel_id, loop
+async def process_image_message(message, image_attachments, guild_config):
+    """Downloads, hashes and duplicate-checks one message's attachments.
+
+    Runs inside a per-guild worker task; messages for one guild are
+    processed in arrival order, and guilds run independently.
+    """
+    guild_id = message.guild.id
+    channel_id = message.channel.id
+    current_user_id = message.author.id
+
+    # Extract remaining settings from the guild's config
+    current_scope = guild_config.duplicate_scope
+    current_mode = guild_config.duplicate_check_mode
+    current_hash_size = guild_config.hash_size
+    current_similarity_threshold = guild_config.similarity_threshold
+    react_to_duplicates = guild_config.react_to_duplicates
+    delete_duplicates = guild_config.delete_duplicates
+    duplicate_reaction_emoji = guild_config.duplicate_reaction_emoji
+
+    # Get the resident hash store for this guild (loads from disk once)
+    store = await get_guild_store(guild_id)
+
+    # Download and hash all attachments concurrently: network reads and
+    # executor-dispatched hashing overlap instead of running serially
+    hash_results = await asyncio.gather(
+        *[_download_and_hash(a, current_hash_size, guild_id) for a in image_attachments]
+    )
+
+    # Apply duplicate checks and inserts sequentially: they mutate the
+    # shared store, and processing in order keeps replies deterministic
+    for attachment, new_hash in hash_results:
+        # Skip attachments whose download or hashing failed
+        if new_hash is None: continue
+        try:
+            # Find potential duplicates based on scope
+            duplicate_matches = await find_duplicates(
+                new_hash, store.index_for(current_scope, channel_id),
+                current_similarity_threshold
+            )
+
+            is_violation = False
+            violating_match = None # Store the specific match that caused the violation
+
+            # Determine if a violation occurred based on check mode
+            if duplicate_matches:
+                if current_mode == "strict":
+                    # Any match is a violation in strict mode
+                    is_violation = True
+                    violating_match = duplicate_matches[0] # Use the closest match for reporting
+                    logger.debug("[G:%s Scope:%s Mode:Strict] Duplicate found.", guild_id, current_scope)
+                elif current_mode == "owner_allowed":
+                    # Check if any match is from a *different* user or has unknown owner
+                    for match in duplicate_matches:
+                        original_owner_id = match.get('original_user_id')
+                        # Violation if owner unknown (old format) or different from current user
+                        if original_owner_id is None or original_owner_id != current_user_id:
+                            is_violation = True
+                            violating_match = match # Use the first violating match
+                            logger.debug("[G:%s Scope:%s Mode:OwnerAllowed] Duplicate found (orig user: %s, curr user: %s)", guild_id, current_scope, original_owner_id, current_user_id)
+                            break # Stop checking once a violation is found
+                    if not is_violation:
+                         # If loop finished without finding a violation, it means all matches were owned by current user
+                         logger.debug("[G:%s Scope:%s Mode:OwnerAllowed] Duplicate found, but current user is owner. Allowing.", guild_id, current_scope)
+
+            # --- Handle Violation (if any) ---
+            if is_violation and violating_match:
+                # Extract details from the violating match
+                identifier = violating_match['identifier']
+                distance = violating_match['distance']
+                original_message_id = violating_match.get('original_message_id')
+                original_user_id = violating_match.get('original_user_id')
+
+                # Construct reply message
+                reply_text = (
+                    f"{duplicate_reaction_emoji} Hold on, {message.author.mention}! Image `{attachment.filename}` is similar "
+                    f"to a prior submission (ID: `{identifier}`, Dist: {distance}"
                 )
+                # Mention original user if known
+                if original_user_id:
+                     reply_text += f", Orig User: <@{original_user_id}>"
+                reply_text += ")."
+
+                # Add jump URL if possible
+                if original_message_id and message.guild:
+                     try:
+                        # Note: Link might point to a different channel if scope is 'server'
+                        jump_url = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{original_message_id}"
+                        reply_text += f"\nOriginal might be here: {jump_url}"
+                     except Exception: pass # Ignore errors creating jump url
+
+                # Send the reply
+                await message.reply(reply_text, mention_author=True)
+
+                # Perform configured actions (react/delete)
+                if react_to_duplicates:
+                    try: await message.add_reaction(duplicate_reaction_emoji)
+                    except Exception as e: logger.warning("[G:%s] Failed reaction: %s", guild_id, e)
+                if delete_duplicates:
+                    # Ensure bot has delete permissions before attempting
+                    if message.channel.permissions_for(message.guild.me).manage_messages:
+                         try: await message.delete()
+                         except Exception as e: logger.warning("[G:%s] Failed delete: %s", guild_id, e)
+                    else: logger.warning("[G:%s] Lacking 'Manage Messages' permission to delete.", guild_id)
+
+
+            # --- Add Unique Hash (if no violation occurred) ---
+            # Add if no matches were found OR if mode is owner_allowed and no violation occurred
+            elif not is_violation:
+                logger.debug("[G:%s Scope:%s] Image '%s' unique or allowed repost. Adding.", guild_id, current_scope, attachment.filename)
+                unique_identifier = f"{message.id}-{attachment.filename}"
+                # Store queues the row for append and updates the live
+                # index; the background flusher persists it
+                store.add(current_scope, channel_id, unique_identifier, new_hash, current_user_id, message.id)
+
+        except discord.HTTPException as e:
+             # Handle potential errors downloading the attachment
+             logger.warning("[G:%s] HTTP error processing attachment '%s': %s", guild_id, attachment.filename, e)
+        except Exception:
+            # Catch any other unexpected errors during processing
+            logger.exception("[G:%s] Error processing attachment '%s'", guild_id, attachment.filename)
 
-                is_violation = False
-                violating_match = None # Store the specific match that caused the violation
-
-                # Determine if a violation occurred based on check mode
-                if duplicate_matches:
-                    if current_mode == "strict":
-                        # Any match is a violation in strict mode
-                        is_violation = True
-                        violating_match = duplicate_matches[0] # Use the closest match for reporting
-                        print(f"DEBUG: [G:{guild_id} Scope:{current_scope} Mode:Strict] Duplicate Found!")
-                    elif current_mode == "owner_allowed":
-                        # Check if any match is from a *different* user or has unknown owner
-                        for match in duplicate_matches:
-                            original_owner_id = match.get('original_user_id')
-                            # Violation if owner unknown (old format) or different from current user
-                            if original_owner_id is None or original_owner_id != current_user_id:
-                                is_violation = True
-                                violating_match = match # Use the first violating match
-                                print(f"DEBUG: [G:{guild_id} Scope:{current_scope} Mode:OwnerAllowed] Duplicate Found (Orig User: {original_owner_id}, Curr User: {current_user_id})")
-                                break # Stop checking once a violation is found
-                        if not is_violation:
-                             # If loop finished without finding a violation, it means all matches were owned by current user
-                             print(f"DEBUG: [G:{guild_id} Scope:{current_scope} Mode:OwnerAllowed] Duplicate Found, but current user is owner. Allowing.")
-
-                # --- Handle Violation (if any) ---
-                if is_violation and violating_match:
-                    # Extract details from the violating match
-                    identifier = violating_match['identifier']
-                    distance = violating_match['distance']
-                    original_message_id = violating_match.get('original_message_id')
-                    original_user_id = violating_match.get('original_user_id')
-
-                    # Construct reply message
-                    reply_text = (
-                        f"{duplicate_reaction_emoji} Hold on, {message.author.mention}! Image `{attachment.filename}` is similar "
-                        f"to a prior submission (ID: `{identifier}`, Dist: {distance}"
-                    )
-                    # Mention original user if known
-                    if original_user_id:
-                         reply_text += f", Orig User: <@{original_user_id}>"
-                    reply_text += ")."
-
-                    # Add jump URL if possible
-                    if original_message_id and message.guild:
-                         try:
-                            # Note: Link might point to a different channel if scope is 'server'
-                            jump_url = f"https://discord.com/channels/{message.guild.id}/{message.channel.id}/{original_message_id}"
-                            reply_text += f"\nOriginal might be here: {jump_url}"
-                         except Exception: pass # Ignore errors creating jump url
-
-                    # Send the reply
-                    await message.reply(reply_text, mention_author=True)
-
-                    # Perform configured actions (react/delete)
-                    if react_to_duplicates:
-                        try: await message.add_reaction(duplicate_reaction_emoji)
-                        except Exception as e: print(f"DEBUG: [G:{guild_id}] Failed reaction: {e}")
-                    if delete_duplicates:
-                        # Ensure bot has delete permissions before attempting
-                        if message.channel.permissions_for(message.guild.me).manage_messages:
-                             try: await message.delete()
-                             except Exception as e: print(f"DEBUG: [G:{guild_id}] Failed delete: {e}")
-                        else: print(f"DEBUG: [G:{guild_id}] Lacking 'Manage Messages' permission to delete.")
-
-
-                # --- Add Unique Hash (if no violation occurred) ---
-                # Add if no matches were found OR if mode is owner_allowed and no violation occurred
-                elif not is_violation:
-                    print(f"DEBUG: [G:{guild_id} Scope:{current_scope}] Image '{attachment.filename}' unique or allowed repost. Adding.")
-                    unique_identifier = f"{message.id}-{attachment.filename}"
-                    # Store in new format: { "hash": "...", "user_id": ... }
-                    hash_data_to_store = {"hash": str(new_hash), "user_id": current_user_id}
-
-                    # Add the hash data based on the current scope
-                    if current_scope == "server":
-                        # Ensure root level is a dict
-                        if not isinstance(stored_hashes, dict): stored_hashes = {}
-                        stored_hashes[unique_identifier] = hash_data_to_store
-                    elif current_scope == "channel":
-                        # Ensure root level is a dict
-                        if not isinstance(stored_hashes, dict): stored_hashes = {}
-                        # Get or create the dict for this specific channel
-                        channel_hashes = stored_hashes.setdefault(channel_id_str, {})
-                        # Ensure the channel data is actually a dict (safety check)
-                        if not isinstance(channel_hashes, dict):
-                            channel_hashes = {}
-                            stored_hashes[channel_id_str] = channel_hashes
-                        # Add the hash data to the channel's dict
-                        channel_hashes[unique_identifier] = hash_data_to_store
-
-                    db_updated = True # Mark that the hash DB needs saving
-
-            except discord.HTTPException as e:
-                 # Handle potential errors downloading the attachment
-                 print(f"DEBUG: [G:{guild_id}] HTTP Error processing attachment '{attachment.filename}': {e}", file=sys.stderr)
-            except Exception as e:
-                # Catch any other unexpected errors during processing
-                print(f"DEBUG: [G:{guild_id}] Error processing attachment '{attachment.filename}': {e}", file=sys.stderr)
-                traceback.print_exc()
-
-    # Save the hash database if any new hashes were added
-    if db_updated:
-        print(f"DEBUG: [G:{guild_id}] Saving updated hash database...")
-        await save_guild_hashes(guild_id, stored_hashes, loop)
 
 
 # --- Configuration Commands (Scope/Mode Aware) ---
 
+# Admin-permission results keyed by (guild_id, user_id, top_role_id) with a
+# short TTL: ctx.author.guild_permissions walks the full role hierarchy on
+# every access, which adds up for rapid command bursts. Member-update
+# events need the privileged members intent (not enabled here), so
+# staleness after a role change is bounded solely by the TTL.
+_PERM_CACHE = {}
+_PERM_CACHE_TTL = 5.0
+
+def _is_admin_cached():
+    """Drop-in replacement for has_permissions(administrator=True) that
+    caches the computed permission briefly. Raises the same exceptions so
+    config_error's friendly messages keep working."""
+    def predicate(ctx):
+        if ctx.guild is None:
+            raise commands.NoPrivateMessage()
+        key = (ctx.guild.id, ctx.author.id, ctx.author.top_role.id)
+        now = time.monotonic()
+        cached = _PERM_CACHE.get(key)
+        if cached is not None and now - cached[0] < _PERM_CACHE_TTL:
+            is_admin = cached[1]
+        else:
+            is_admin = ctx.author.guild_permissions.administrator
+            if len(_PERM_CACHE) > 1024:
+                # Drop expired entries so the cache stays bounded
+                for k in [k for k, v in _PERM_CACHE.items() if now - v[0] >= _PERM_CACHE_TTL]:
+                    del _PERM_CACHE[k]
+            _PERM_CACHE[key] = (now, is_admin)
+        if not is_admin:
+            raise commands.MissingPermissions(['administrator'])
+        return True
+    return commands.check(predicate)
+
+def with_guild_config(func):
+    """Decorator for config commands that edit settings.
+
+    Injects the invoking guild's live config as the second argument; the
+    command validates, sends its own feedback, and returns a staged copy
+    to persist (or None when nothing changed). Persistence and the
+    save-failure message live here instead of being repeated per command.
+    """
+    @wraps(func)
+    async def wrapper(ctx, *args, **kwargs):
+        guild_id = ctx.guild.id
+        updated = await func(ctx, get_guild_config(guild_id), *args, **kwargs)
+        if updated is not None and not await save_guild_config(guild_id, updated):
+            await ctx.send("⚠️ Failed to save config.")
+    # Hide the injected guild_config parameter from discord.py's argument
+    # parser, which reads the callback signature to build converters
+    params = [p for name, p in inspect.signature(func).parameters.items()
+              if name != 'guild_config']
+    wrapper.__signature__ = inspect.Signature(params)
+    return wrapper
+
+# Embed accent color; discord.Color.blue() builds a new object each call,
+# so the shared instance is hoisted here
+_COLOR_BLUE = discord.Color.blue()
+
+# Rendered !config embeds, keyed by guild id. save_guild_config() pops the
+# entry whenever a setting changes, so repeat !config calls skip the
+# per-field formatting work entirely.
+_EMBED_CACHE = {}
+
+# Channel id -> '<#id>' mention strings, shared across display commands so
+# large allow-lists aren't re-formatted on every embed rebuild
+_CHAN_MENTION_CACHE = {}
+
+def _chan_mention(ch_id):
+    """Returns the (cached) mention string for a channel id."""
+    mention = _CHAN_MENTION_CACHE.get(ch_id)
+    if mention is None:
+        mention = _CHAN_MENTION_CACHE[ch_id] = f'<#{ch_id}>'
+    return mention
+
+# Pre-bound formatter for the '!config channel' listing; mapping it over
+# the ids avoids a per-line generator frame and format-string re-parse
+_CHAN_LINE = "- <#{0}> (`{0}`)".format
+
 # Decorators must be on separate lines
 @bot.group(name="config", invoke_without_command=True)
 @commands.guild_only() # Ensure command is run in a server
-@commands.has_permissions(administrator=True) # Check for admin permissions
+@_is_admin_cached() # Cached admin permission check
 async def configcmd(ctx):
     """Base command shows current server settings."""
     guild_id = ctx.guild.id
+    cached = _EMBED_CACHE.get(guild_id)
+    if cached is not None:
+        await ctx.send(embed=cached)
+        return
     guild_config = get_guild_config(guild_id) # Get config for the command's guild
 
-    embed = discord.Embed(title=f"Bot Configuration for {ctx.guild.name}", color=discord.Color.blue())
+    embed = discord.Embed(title=f"Bot Configuration for {ctx.guild.name}", color=_COLOR_BLUE)
 
     # Display scope and mode prominently
-    scope = guild_config.get('duplicate_scope', 'server')
-    mode = guild_config.get('duplicate_check_mode', 'strict')
+    scope = guild_config.duplicate_scope
+    mode = guild_config.duplicate_check_mode
     embed.add_field(name="Duplicate Scope", value=f"`{scope}`", inline=True)
     embed.add_field(name="Duplicate Check Mode", value=f"`{mode}`", inline=True)
     embed.add_field(name="\u200b", value="\u200b", inline=True) # Invisible spacer field
 
     # Display other settings
-    for key, value in guild_config.items():
+    for key, value in guild_config.to_dict().items():
         # Skip keys already displayed
         if key in ['duplicate_scope', 'duplicate_check_mode']: continue
 
         display_value = value # Default display
         # Format specific keys for better readability
         if key == 'allowed_channel_ids':
-            display_value = ', '.join(f'<#{ch_id}>' for ch_id in value) if value else "All Channels"
+            display_value = ', '.join([_chan_mention(ch_id) for ch_id in value]) if value else "All Channels"
         elif key == 'hash_db_file':
              display_value = f"`{value}`" # Use code formatting for filename
         elif isinstance(value, bool):
             display_value = "Enabled" if value else "Disabled" # Display booleans nicely
 
         # Add field to embed
-        embed.add_field(name=key.replace('_', ' ').title(), value=display_value, inline=False)
+        embed.add_field(name=_FIELD_LABELS[key], value=display_value, inline=False)
 
+    _EMBED_CACHE[guild_id] = embed
     await ctx.send(embed=embed)
 
 @configcmd.error
@@ -632,184 +1319,281 @@ async def config_error(ctx, error):
     elif isinstance(error, commands.CommandInvokeError):
         # Show the original error that occurred within the command
         await ctx.send(f"An error occurred while executing the command: {error.original}")
-        traceback.print_exc() # Log the full traceback for debugging
+        logger.error("Error executing config command", exc_info=error.original)
     else:
         # Catch any other unexpected errors
         await ctx.send(f"An unexpected error occurred: {error}")
 
+# --- Setting Validators ('config set' dispatch) ---
+# Each validator returns (new_value, error_msg); exactly one side is non-None.
+# Hoisted to module level so the table is built once, not per command call.
+
+async def _validate_scope(ctx, value):
+    value_lower = value.lower()
+    if value_lower in VALID_SCOPES: return value_lower, None
+    return None, f"Invalid scope. Use: `{', '.join(sorted(VALID_SCOPES))}`"
+
+async def _validate_check_mode(ctx, value):
+    value_lower = value.lower()
+    if value_lower in VALID_CHECK_MODES: return value_lower, None
+    return None, f"Invalid mode. Use: `{', '.join(sorted(VALID_CHECK_MODES))}`"
+
+def _parse_bounded_int(value, lo):
+    """Parses value as an int no smaller than lo; returns (n, error_msg).
+
+    The isdigit pre-check keeps bad input on a cheap boolean path instead
+    of paying for a raised-and-caught ValueError.
+    """
+    stripped = value.strip()
+    # removeprefix, not lstrip: '--3' must stay invalid
+    if not stripped.removeprefix('-').isdigit():
+        return None, "Invalid value format. Expected a number."
+    n = int(stripped)
+    if n < lo: return None, f"Value must be {lo} or greater."
+    return n, None
+
+async def _validate_threshold(ctx, value):
+    return _parse_bounded_int(value, 0)
+
+async def _validate_hash_size(ctx, value):
+    # Practical minimum hash size for a useful dhash is 4
+    return _parse_bounded_int(value, 4)
+
+async def _validate_bool(ctx, value):
+    # Flexible boolean parsing
+    token = value.lower()
+    if token in _TRUE_TOKENS: return True, None
+    if token in _FALSE_TOKENS: return False, None
+    return None, "Value must be true/false (or on/off, yes/no, 1/0)."
+
+# Custom guild emoji markup: <:name:id> or <a:name:id> for animated ones
+_CUSTOM_EMOJI_RE = re.compile(r'<a?:\w{2,32}:(\d{15,20})>')
+# Match exactly ONE Unicode emoji sequence: a pictograph with optional
+# variation selector and skin tone, extended only by ZWJ-joined parts, or
+# a two-letter flag. Concatenations of independent emoji ('X' 'Y') must
+# NOT match here — add_reaction would reject them, so they fall through
+# to the reaction probe, which catches them at set time.
+# Base class sticks to actual emoji blocks — the wide symbol ranges also
+# contain Braille, box drawing and mahjong tiles, which Discord refuses
+# as reactions, so sweeping them in here would persist unusable values
+_EMOJI_BASE = ("[\u00A9\u00AE\u203C\u2049\u2122\u2139"
+               "\u2194-\u2199\u21A9\u21AA\u231A\u231B\u2328\u23CF"
+               "\u23E9-\u23F3\u23F8-\u23FA\u24C2\u25AA\u25AB\u25B6"
+               "\u25C0\u25FB-\u25FE\u2600-\u27BF\u2934\u2935"
+               "\u2B05-\u2B07\u2B1B\u2B1C\u2B50\u2B55"
+               "\u3030\u303D\u3297\u3299"
+               "\U0001F004\U0001F0CF\U0001F170\U0001F171\U0001F17E"
+               "\U0001F17F\U0001F18E\U0001F191-\U0001F19A"
+               "\U0001F201\U0001F202\U0001F21A\U0001F22F"
+               "\U0001F232-\U0001F23A\U0001F250\U0001F251"
+               "\U0001F300-\U0001F6FF\U0001F7E0-\U0001F7F0"
+               "\U0001F900-\U0001F9FF\U0001FA70-\U0001FAFF]"
+               "[\uFE0E\uFE0F]?[\U0001F3FB-\U0001F3FF]?")
+_UNICODE_EMOJI_RE = re.compile(
+    f"(?:{_EMOJI_BASE}(?:\u200D{_EMOJI_BASE})*"
+    f"|[\U0001F1E6-\U0001F1FF]{{2}})")
+
+async def _validate_emoji(ctx, value):
+    # Fast path: Unicode emoji validate locally, skipping two REST calls
+    if _UNICODE_EMOJI_RE.fullmatch(value):
+        return value, None
+    # Custom emoji from this guild resolve from the local cache, no HTTP
+    match = _CUSTOM_EMOJI_RE.fullmatch(value)
+    if match is not None and discord.utils.get(ctx.guild.emojis, id=int(match.group(1))) is not None:
+        return value, None
+    # Anything else (keycap sequences, emoji from other shared guilds, junk):
+    # validate by trying to react with it
+    try:
+        await ctx.message.add_reaction(value)
+        # Clean up the test reaction immediately
+        await ctx.message.remove_reaction(value, ctx.me)
+        return value, None
+    except discord.HTTPException:
+        return None, "Invalid emoji provided. Please use a standard Unicode emoji or a custom emoji the bot can access."
+
+# Settable keys mapped to their validators
+_SETTING_VALIDATORS = {
+    'similarity_threshold': _validate_threshold,
+    'hash_size': _validate_hash_size,
+    'react_to_duplicates': _validate_bool,
+    'delete_duplicates': _validate_bool,
+    'duplicate_reaction_emoji': _validate_emoji,
+    'duplicate_scope': _validate_scope,
+    'duplicate_check_mode': _validate_check_mode,
+}
+
 # Decorators must be on separate lines
 @configcmd.command(name='set')
 @commands.guild_only()
-@commands.has_permissions(administrator=True)
-async def config_set(ctx, setting: str, *, value: str):
+@_is_admin_cached()
+@with_guild_config
+async def config_set(ctx, guild_config, setting: str, *, value: str):
     """Sets a config value. Usage: !config set <setting> <value>"""
-    guild_id = ctx.guild.id
-    # Get a copy of the current config to modify
-    guild_config = get_guild_config(guild_id).copy()
     # Normalize setting name (lowercase, underscores)
     setting = setting.lower().replace('-', '_')
 
-    # Define valid settings that can be changed via command
-    valid_settings = [
-        'similarity_threshold', 'hash_size', 'react_to_duplicates',
-        'delete_duplicates', 'duplicate_reaction_emoji',
-        'duplicate_scope', 'duplicate_check_mode'
-    ]
     # Check if the provided setting is valid
-    if setting not in valid_settings:
-        await ctx.send(f"❌ Unknown setting '{setting}'. Settable keys: `{', '.join(valid_settings)}`")
-        return
+    validator = _SETTING_VALIDATORS.get(setting)
+    if validator is None:
+        await ctx.send(f"❌ Unknown setting '{setting}'. Settable keys: `{', '.join(_SETTING_VALIDATORS)}`")
+        return None
 
-    original_value = guild_config.get(setting) # Get original value for feedback message
-    new_value = None # Variable to store the validated new value
-    error_msg = None # Variable to store validation error messages
+    original_value = getattr(guild_config, setting) # Get original value for feedback message
 
-    # Validate and coerce the input value based on the setting name
+    # Validate and coerce the input value via the dispatch table
     try:
-        if setting == 'duplicate_scope':
-            value_lower = value.lower()
-            if value_lower in VALID_SCOPES: new_value = value_lower
-            else: error_msg = f"Invalid scope. Use: `{', '.join(VALID_SCOPES)}`"
-        elif setting == 'duplicate_check_mode':
-             value_lower = value.lower()
-             if value_lower in VALID_CHECK_MODES: new_value = value_lower
-             else: error_msg = f"Invalid mode. Use: `{', '.join(VALID_CHECK_MODES)}`"
-        elif setting == 'similarity_threshold':
-            new_value = int(value)
-            if new_value < 0: error_msg = "Threshold must be 0 or greater."
-        elif setting == 'hash_size':
-            new_value = int(value)
-            # Practical minimum hash size for imagehash
-            if new_value < 4: error_msg = "Hash size must be at least 4."
-        elif setting in ['react_to_duplicates', 'delete_duplicates']:
-            # Flexible boolean parsing
-            if value.lower() in ['true', 'on', 'yes', '1', 'enable', 'enabled']: new_value = True
-            elif value.lower() in ['false', 'off', 'no', '0', 'disable', 'disabled']: new_value = False
-            else: error_msg = "Value must be true/false (or on/off, yes/no, 1/0)."
-        elif setting == 'duplicate_reaction_emoji':
-            # Validate emoji by trying to react with it
-            try:
-                await ctx.message.add_reaction(value)
-                # Clean up the test reaction immediately
-                await ctx.message.remove_reaction(value, ctx.me)
-                new_value = value # Store the valid emoji
-            except discord.HTTPException:
-                error_msg = "Invalid emoji provided. Please use a standard Unicode emoji or a custom emoji the bot can access."
-    except ValueError:
-        error_msg = f"Invalid value format for '{setting}'. Expected a number."
+        new_value, error_msg = await validator(ctx, value)
     except Exception as e:
-        error_msg = f"Unexpected validation error: {e}"
+        new_value, error_msg = None, f"Unexpected validation error: {e}"
 
     # If validation failed, send error message and stop
     if error_msg:
         await ctx.send(f"❌ Error setting '{setting}': {error_msg}")
-        return
+        return None
 
-    # Check if a valid new value was determined (or if setting a boolean to False)
-    is_boolean_setting = setting in ['react_to_duplicates', 'delete_duplicates']
-    if new_value is not None or (is_boolean_setting and new_value is False) :
-        # Update the configuration dictionary (copy)
-        guild_config[setting] = new_value
-        # Save the updated configuration for this guild
-        if await save_guild_config(guild_id, guild_config):
-            await ctx.send(f"✅ Updated '{setting}' for this server from `{original_value}` to `{new_value}`.")
-            # Add warning if changing scope with existing data
-            if setting == 'duplicate_scope':
-                 await ctx.send(f"⚠️ **Warning:** Changing scope might affect how existing hashes are read/stored. If you have existing data in `{guild_config['hash_db_file']}`, consider clearing it manually if switching between `server` and `channel` scopes.")
-        else:
-            # Inform user if saving failed
-            await ctx.send(f"⚠️ Failed to save configuration update to file.")
-    else:
+    # Skip the save entirely when nothing would change
+    if new_value == original_value:
+        await ctx.send(f"ℹ️ '{setting}' is already set to `{new_value}`.")
+        return None
+
+    # False (for booleans) is a valid outcome; only None means "no value"
+    if new_value is None:
         # Should not happen if validation logic is correct, but as a fallback
-         await ctx.send(f"❌ Could not determine a valid value for '{setting}' from input '{value}'.")
+        await ctx.send(f"❌ Could not determine a valid value for '{setting}' from input '{value}'.")
+        return None
+
+    # Stage the edit on a copy now that validation has succeeded
+    guild_config = guild_config.copy()
+    setattr(guild_config, setting, new_value)
+    await ctx.send(f"✅ Updated '{setting}' for this server from `{original_value}` to `{new_value}`.")
+    # Add warning if changing scope with existing data
+    if setting == 'duplicate_scope':
+         await ctx.send(f"⚠️ **Warning:** Changing scope might affect how existing hashes are read/stored. If you have existing data in `{guild_config.hash_db_file}`, consider clearing it manually if switching between `server` and `channel` scopes.")
+    # Keep the resident hash store in step so rows queued after the change
+    # are packed for the new width
+    if setting == 'hash_size':
+        store = guild_stores.get(ctx.guild.id)
+        if store is not None: store.hash_size = new_value
+    return guild_config
 
 
 # Decorators must be on separate lines
 @configcmd.group(name='channel', invoke_without_command=True)
 @commands.guild_only()
-@commands.has_permissions(administrator=True)
+@_is_admin_cached()
 async def config_channel(ctx):
     """Manage the allowed channel list for this server."""
     guild_id = ctx.guild.id; guild_config = get_guild_config(guild_id)
-    channel_list = guild_config.get('allowed_channel_ids')
+    channel_list = guild_config.allowed_channel_ids
     if channel_list:
-        embed = discord.Embed(title=f"Allowed Channels for {ctx.guild.name}", description='\n'.join(f"- <#{ch_id}> (`{ch_id}`)" for ch_id in channel_list), color=discord.Color.blue())
+        embed = discord.Embed(title=f"Allowed Channels for {ctx.guild.name}", description='\n'.join(map(_CHAN_LINE, sorted(channel_list))), color=_COLOR_BLUE)
         await ctx.send(embed=embed)
     else: await ctx.send("ℹ️ Monitoring all channels in this server.")
 
 # Decorators must be on separate lines
 @config_channel.command(name='add')
 @commands.guild_only()
-@commands.has_permissions(administrator=True)
-async def config_channel_add(ctx, channel: discord.TextChannel):
+@_is_admin_cached()
+@with_guild_config
+async def config_channel_add(ctx, guild_config, channel: discord.TextChannel):
     """Adds a channel to the allowed list for this server."""
-    guild_id = ctx.guild.id; guild_config = get_guild_config(guild_id).copy(); channel_id = channel.id
-    # Initialize list if it's currently None
-    if guild_config.get('allowed_channel_ids') is None: guild_config['allowed_channel_ids'] = []
-    # Add channel if not already present
-    if channel_id not in guild_config['allowed_channel_ids']:
-        guild_config['allowed_channel_ids'].append(channel_id)
-        # Save the updated config
-        if await save_guild_config(guild_id, guild_config): await ctx.send(f"✅ Added <#{channel_id}> to allowed list.")
-        else: await ctx.send(f"⚠️ Failed to save config.")
-    else: await ctx.send(f"ℹ️ <#{channel_id}> already allowed.")
+    channel_id = channel.id
+    allowed = guild_config.allowed_channel_ids
+    # Add channel if not already present (set membership is O(1));
+    # copy only happens once we know there is something to change
+    if allowed is not None and channel_id in allowed:
+        await ctx.send(f"ℹ️ <#{channel_id}> already allowed.")
+        return None
+    guild_config = guild_config.copy()
+    if guild_config.allowed_channel_ids is None: guild_config.allowed_channel_ids = set()
+    guild_config.allowed_channel_ids.add(channel_id)
+    await ctx.send(f"✅ Added <#{channel_id}> to allowed list.")
+    return guild_config
 
 # Decorators must be on separate lines
 @config_channel.command(name='remove')
 @commands.guild_only()
-@commands.has_permissions(administrator=True)
-async def config_channel_remove(ctx, channel: discord.TextChannel):
+@_is_admin_cached()
+@with_guild_config
+async def config_channel_remove(ctx, guild_config, channel: discord.TextChannel):
     """Removes a channel from the allowed list for this server."""
-    guild_id = ctx.guild.id; guild_config = get_guild_config(guild_id).copy(); channel_id = channel.id
-    # Check if the list exists and the channel is in it
-    if guild_config.get('allowed_channel_ids') and channel_id in guild_config['allowed_channel_ids']:
-        guild_config['allowed_channel_ids'].remove(channel_id)
-        # If list becomes empty after removal, set it back to None
-        if not guild_config['allowed_channel_ids']: guild_config['allowed_channel_ids'] = None
-        # Save the updated config
-        if await save_guild_config(guild_id, guild_config): await ctx.send(f"✅ Removed <#{channel_id}> from allowed list.")
-        else: await ctx.send(f"⚠️ Failed to save config.")
-    else: await ctx.send(f"ℹ️ <#{channel_id}> not in allowed list.")
+    channel_id = channel.id
+    # Check if the set exists and the channel is in it before copying
+    if not guild_config.allowed_channel_ids or channel_id not in guild_config.allowed_channel_ids:
+        await ctx.send(f"ℹ️ <#{channel_id}> not in allowed list.")
+        return None
+    guild_config = guild_config.copy()
+    guild_config.allowed_channel_ids.discard(channel_id)
+    # If the set becomes empty after removal, set it back to None
+    if not guild_config.allowed_channel_ids: guild_config.allowed_channel_ids = None
+    await ctx.send(f"✅ Removed <#{channel_id}> from allowed list.")
+    return guild_config
 
 # Decorators must be on separate lines
 @config_channel.command(name='clear')
 @commands.guild_only()
-@commands.has_permissions(administrator=True)
-async def config_channel_clear(ctx):
+@_is_admin_cached()
+@with_guild_config
+async def config_channel_clear(ctx, guild_config):
     """Clears the allowed channel list for this server (monitors all)."""
-    guild_id = ctx.guild.id; guild_config = get_guild_config(guild_id).copy()
-    # Check if the list is already None or empty
-    if guild_config.get('allowed_channel_ids') is not None:
-        guild_config['allowed_channel_ids'] = None # Set to None to monitor all
-        # Save the updated config
-        if await save_guild_config(guild_id, guild_config): await ctx.send("✅ Cleared allowed channels. Monitoring all.")
-        else: await ctx.send(f"⚠️ Failed to save config.")
-    else: await ctx.send("ℹ️ Already monitoring all channels.")
+    # Check if the list is already None before copying
+    if guild_config.allowed_channel_ids is None:
+        await ctx.send("ℹ️ Already monitoring all channels.")
+        return None
+    guild_config = guild_config.copy()
+    guild_config.allowed_channel_ids = None # Set to None to monitor all
+    await ctx.send("✅ Cleared allowed channels. Monitoring all.")
+    return guild_config
 
 # --- Main Execution ---
 if __name__ == "__main__":
+    # Configure logging before anything logs; discord.py adds its own
+    # handler inside bot.run, so only this module's records use this format.
+    # Records go through an in-memory queue drained by a listener thread,
+    # so the event-loop thread never blocks on a synchronous stderr write.
+    _stream_handler = logging.StreamHandler()
+    _stream_handler.setFormatter(
+        logging.Formatter('%(asctime)s %(levelname)-8s %(name)s: %(message)s'))
+    _log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(
+        _log_queue, _stream_handler, respect_handler_level=True)
+    _log_listener.start()
+    logging.basicConfig(
+        level=logging.INFO,
+        handlers=[logging.handlers.QueueHandler(_log_queue)],
+    )
+
     # Check for bot token before starting
     if BOT_TOKEN is None:
-        print("Error: DISCORD_BOT_TOKEN not found in .env file or environment variables.", file=sys.stderr)
+        logger.critical("DISCORD_BOT_TOKEN not found in .env file or environment variables.")
         sys.exit(1)
 
     try:
-        print("Starting bot...")
+        logger.info("Starting bot...")
+        # Spin up the hashing process pool before the event loop starts
+        HASH_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
         # Run the bot with the token
         bot.run(BOT_TOKEN)
     except discord.LoginFailure:
-        print("Error: Invalid Discord Bot Token. Please check the token in your .env file.", file=sys.stderr)
-        traceback.print_exc()
+        logger.exception("Invalid Discord Bot Token. Please check the token in your .env file.")
     except discord.PrivilegedIntentsRequired:
          # Specific error for missing intents
-         print("Error: Privileged Intents (Message Content) are not enabled for the bot.", file=sys.stderr)
-         print("Please go to your bot's settings in the Discord Developer Portal and enable the 'MESSAGE CONTENT INTENT'.", file=sys.stderr)
-         traceback.print_exc()
-    except Exception as e:
+         logger.exception(
+             "Privileged Intents (Message Content) are not enabled for the bot. "
+             "Please go to your bot's settings in the Discord Developer Portal "
+             "and enable the 'MESSAGE CONTENT INTENT'.")
+    except Exception:
         # Catch any other exceptions during startup or runtime
-        print(f"An error occurred while running the bot: {e}", file=sys.stderr)
-        traceback.print_exc()
+        logger.exception("An error occurred while running the bot")
     finally:
         # This block executes whether the bot stops normally or due to an error
-        print("DEBUG: Bot run loop finished or encountered an error.")
+        if HASH_POOL is not None:
+            HASH_POOL.shutdown(wait=False, cancel_futures=True)
+        # Persist any hash inserts the background flusher hadn't written
+        # yet, plus any config change the coalescing saver hadn't flushed
+        flush_dirty_stores_blocking()
+        save_main_config_blocking()
+        logger.debug("Bot run loop finished or encountered an error.")
+        # Drain any queued records before the process exits
+        _log_listener.stop()
 